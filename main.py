@@ -1,67 +1,184 @@
+import asyncio
 import io
 import logging
-import time
-from threading import Condition
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
 
-from flask import Flask, Response, render_template_string
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, RedirectResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
 from picamera2 import Picamera2, Preview
-from picamera2.encoders import H264Encoder
-from picamera2.outputs import FfmpegOutput
+from picamera2.encoders import H264Encoder, JpegEncoder
+from picamera2.outputs import FfmpegOutput, FileOutput
 
 # --- Configuration ---
 CAMERA_RESOLUTION = (640, 480)
+STREAM_RESOLUTION = (640, 480)  # Browser display size, scaled by the ISP; must not exceed CAMERA_RESOLUTION
 FRAME_RATE = 10
+FIRST_FRAME_TIMEOUT = 3.0  # Seconds to wait for the camera to deliver its first frame
 JPEG_QUALITY = 50
+JPEG_THREADS = max(1, (os.cpu_count() or 1) - 1)  # Encode on every core but one, which serves viewers
+MJPEG_BITRATE = 4000000  # For the hardware MJPEG encoder, which is rate controlled instead of q
+BUFFER_COUNT = 8  # Headroom over the video default of 6, so the two encoders never wait on a buffer
 SERVER_PORT = 31001
+SHUTDOWN_TIMEOUT = 2  # Seconds to let viewers disconnect on shutdown before their streams are cancelled
+STATIC_DIR = Path(__file__).resolve().parent / "static"  # index.html is written here at startup
+
+# --- Multipart framing for the MJPEG stream ---
+HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+TAIL = b'\r\n'
+
+# --- HTML page, rendered once since the stream size never changes, and served as a static file ---
+INDEX_HTML = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Raspberry Pi Camera Stream (Picamera2)</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f4f4f4; text-align: center; }
+        h1 { color: #333; }
+        img { border: 2px solid #333; margin-top: 20px; }
+        p { color: #555; }
+    </style>
+</head>
+<body>
+    <h1>Raspberry Pi Camera Live Stream</h1>
+    <img id="video_stream" src="/video_feed" width="{width}" height="{height}" alt="Loading video stream...">
+    <p>Powered by Picamera2 and FastAPI.</p>
+    <script>
+        const img = document.getElementById('video_stream');
+        img.onerror = function() {
+            this.alt = 'Video stream failed to load. Check Pi console for errors.';
+        };
+    </script>
+</body>
+</html>
+""".replace("{width}", str(STREAM_RESOLUTION[0])).replace("{height}", str(STREAM_RESOLUTION[1]))
 
 # --- Global Camera and Streaming Output ---
 picam2 = None
 output_stream = None
+viewers = set()  # One single-slot asyncio.Queue per connected /video_feed client
 
 
-# This class will hold the latest frame and notify waiting threads
+# This class will hold the latest frame and wake the viewers waiting on the event loop
 class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
+    def __init__(self, loop):
         super().__init__() # It's good practice to call super().__init__
-        self.frame = None
-        self.condition = Condition()
+        self.slots = [None, None, None]  # Triple buffer, so the encoder never waits on a viewer
+        self.seq = 0  # Number of frames published so far
+        self._loop = loop  # The server's event loop, which consumes the frames
+        self._aevent = asyncio.Event()
 
     def write(self, buf):
         # The write method should return the number of bytes written.
         bytes_written = len(buf)
-        with self.condition:
-            self.frame = buf
-            self.condition.notify_all()  # Notify all waiting threads
+        seq = self.seq
+        # Store the whole multipart part, framed once here on the encoder thread rather than per
+        # viewer; the join also copies buf, so no encoder buffer (mmap/memoryview) is ever pinned
+        self.slots[seq % 3] = b''.join((HEADER, buf, TAIL))
+        self.seq = seq + 1  # Publishing is a single int store, atomic under the GIL
+        # write() runs on the encoder thread, so hand the wakeup over to the event loop
+        try:
+            self._loop.call_soon_threadsafe(self._aevent.set)
+        except RuntimeError:
+            pass  # The loop is closed (forced exit) and the camera not yet shut down: nobody to wake
         return bytes_written # Return the number of bytes written
 
+    async def next_frame(self, last_seen):
+        """Wait for a frame newer than last_seen. Only meant for a single consumer."""
+        while self.seq == last_seen:
+            await self._aevent.wait()
+            self._aevent.clear()
+        return self.latest()
 
-# --- Flask Application ---
-app = Flask(__name__)
+    def latest(self):
+        """Return the sequence number and the most recently published frame, framed for multipart."""
+        seq = self.seq
+        return seq, self.slots[(seq - 1) % 3] if seq else None
+
+
+# --- ASGI Application ---
+@asynccontextmanager
+async def lifespan(app):
+    STATIC_DIR.mkdir(exist_ok=True)
+    (STATIC_DIR / "index.html").write_text(INDEX_HTML)
+    # The camera is started here so StreamingOutput can be bound to the running event loop
+    if not await initialize_camera_and_start_streaming():
+        raise RuntimeError("Application cannot start due to camera initialization failure.")
+    publisher = asyncio.create_task(publish_frames())
+    try:
+        yield
+    finally:
+        publisher.cancel()
+        shutdown_camera()
 
 
-def initialize_camera_and_start_streaming():
+app = FastAPI(lifespan=lifespan)
+# In production, let Nginx serve the page from disk and only proxy the stream, e.g.:
+#   location = / { return 302 /static/index.html; }
+#   location /static/ { alias /path/to/piCam/static/; }
+#   location /video_feed { proxy_pass http://127.0.0.1:31001; proxy_buffering off; proxy_read_timeout 3600s; }
+app.mount('/static', StaticFiles(directory=STATIC_DIR, check_dir=False), name='static')
+
+
+def start_mjpeg_encoder(output):
+    """Encode the lores stream on the VC4 hardware MJPEG encoder, or in software where there is none (Pi 5)."""
+    encoder = None
+    try:
+        # Imported from its module directly: picamera2.encoders.MJPEGEncoder is rebound to a
+        # libav software encoder off VC4, and /dev/video11 is only opened by start_encoder()
+        from picamera2.encoders.mjpeg_encoder import MJPEGEncoder
+        encoder = MJPEGEncoder(bitrate=MJPEG_BITRATE)
+        picam2.start_encoder(encoder, FileOutput(output), name="lores")
+        return
+    except Exception as e:
+        logging.warning(f"Hardware MJPEG encoder unavailable, encoding JPEGs in software: {e}")
+        # start_encoder() only registers the encoder once it has started, so a half-started
+        # one (device open, poll thread maybe running) has to be stopped here directly
+        if encoder is not None and encoder.running:
+            try:
+                encoder.stop()
+            except Exception as stop_e:
+                logging.error(f"Error stopping the hardware MJPEG encoder: {stop_e}")
+    picam2.start_encoder(JpegEncoder(num_threads=JPEG_THREADS, q=JPEG_QUALITY), FileOutput(output), name="lores")
+
+
+async def initialize_camera_and_start_streaming():
     global picam2, output_stream
     try:
         picam2 = Picamera2()
 
-        config = picam2.create_still_configuration(
+        # Pin the frame duration so the sensor delivers at a steady FRAME_RATE cadence
+        frame_duration = int(1_000_000 / FRAME_RATE)
+        config = picam2.create_video_configuration(
             main={"size": CAMERA_RESOLUTION},
-            controls={"FrameRate": FRAME_RATE}
+            lores={"size": STREAM_RESOLUTION, "format": "YUV420"},
+            encode="lores",
+            buffer_count=BUFFER_COUNT,
+            controls={"FrameDurationLimits": (frame_duration, frame_duration)}
         )
         picam2.configure(config)
         picam2.start_preview(Preview.NULL)
-        encoder = H264Encoder(10000000)
-        picam2.start()
 
-        video_output = FfmpegOutput("-f mpegts udp://192.168.0.154:31001/video")
-        picam2.start_recording(encoder, output=video_output, name="video.ts")
+        # The MJPEG feed gets already-compressed JPEGs from its own encoder
+        output_stream = StreamingOutput(asyncio.get_running_loop())
+        start_mjpeg_encoder(output_stream)
 
-        output_stream = StreamingOutput()
+        encoder = H264Encoder(10000000)
+        video_output = FfmpegOutput("-f mpegts udp://192.168.0.154:31001/video")
+        picam2.start_recording(encoder, output=video_output, name="main")
 
-        logging.info(f"Camera initialized. Streaming at {CAMERA_RESOLUTION} resolution, {FRAME_RATE} FPS.")
+        logging.info(f"Camera initialized. Recording at {CAMERA_RESOLUTION}, streaming at {STREAM_RESOLUTION}, {FRAME_RATE} FPS.")
         logging.info(f"Camera controls: {picam2.camera_controls}")
 
-        time.sleep(1.5)
+        # Ready as soon as the sensor delivers, and never before, so no viewer gets an empty stream
+        try:
+            await asyncio.wait_for(output_stream.next_frame(0), timeout=FIRST_FRAME_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"No frame from the camera within {FIRST_FRAME_TIMEOUT} seconds")
         return True
     except Exception as e:
         # Ensure the full exception (including "must pass output") is logged
@@ -77,95 +194,94 @@ def initialize_camera_and_start_streaming():
         return False
 
 
-def generate_frames():
-    """Generator function to yield frames for the MJPEG stream."""
-    global output_stream # Ensure we're using the global output_stream
-    if not picam2: # or not output_stream or not picam2.started: # Added check for picam2.started
+def shutdown_camera():
+    global picam2
+    if picam2:
+        logging.info("Shutting down camera...")
+        try:
+            if picam2.started: # Check if recording was started before trying to stop
+                picam2.stop_recording()
+                logging.info("Camera recording stopped.")
+        except Exception as e:
+            logging.error(f"Error stopping recording: {e}", exc_info=True)
+        try:
+            picam2.close()
+            logging.info("Camera closed.")
+        except Exception as e:
+            logging.error(f"Error closing camera: {e}", exc_info=True)
+        picam2 = None # Safe to call again from __main__ if the lifespan already shut it down
+
+
+async def publish_frames():
+    """Background task that hands every new frame to each connected viewer."""
+    # Hoisted out of the per-frame loop below
+    next_frame, queues = output_stream.next_frame, viewers
+    last_seen = 0
+    while True:
+        # next_frame() returns only the newest frame, and every viewer shares its framed bytes
+        last_seen, chunk = await next_frame(last_seen)
+        for queue in queues:
+            if queue.full():
+                # Drop the frame a slow viewer hasn't picked up yet so it can't hold anyone back
+                queue.get_nowait()
+            queue.put_nowait(chunk)
+
+
+async def generate_frames():
+    """Async generator to yield frames for the MJPEG stream."""
+    if not picam2 or not output_stream:
         logging.error("Camera or output stream not initialized/started for generating frames.")
         return
 
-    while True:
-        try:
-            frame = picam2.capture_array("main")
-            if frame:
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame.tobytes() + b'\r\n')
-            else:
-                # This might happen if the stream stops or an error occurs
-                logging.warning("Frame was None after condition signaled, skipping.")
-                time.sleep(0.01) # Brief pause
-        except Exception as e:
-            logging.error(f"Error in generate_frames: {e}", exc_info=True)
-            break
-
-
-@app.route('/')
-def index():
-    """Serves the main HTML page with the video feed."""
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Raspberry Pi Camera Stream (Picamera2)</title>
-        <style>
-            body { font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f4f4f4; text-align: center; }
-            h1 { color: #333; }
-            img { border: 2px solid #333; margin-top: 20px; }
-            p { color: #555; }
-        </style>
-    </head>
-    <body>
-        <h1>Raspberry Pi Camera Live Stream</h1>
-        <img id="video_stream" src="{{ url_for('video_feed') }}" width="{{width}}" height="{{height}}" alt="Loading video stream...">
-        <p>Powered by Picamera2 and Flask.</p>
-        <script>
-            const img = document.getElementById('video_stream');
-            img.onerror = function() {
-                this.alt = 'Video stream failed to load. Check Pi console for errors.';
-            };
-        </script>
-    </body>
-    </html>
-    """
-    return render_template_string(html_content, width=CAMERA_RESOLUTION[0], height=CAMERA_RESOLUTION[1])
-
-
-@app.route('/video_feed')
-def video_feed():
+    queue = asyncio.Queue(maxsize=1)
+    viewers.add(queue)
+    get, now, frame_interval = queue.get, asyncio.get_running_loop().time, 1 / FRAME_RATE
+    try:
+        while True:
+            chunk = await get()
+            started = now()
+            yield chunk  # Resumes once the server has written it, after draining if the socket was full
+            if now() - started > frame_interval and not queue.empty():
+                # The socket took longer than a frame to drain: skip the frame queued meanwhile
+                # so a backed-up viewer (e.g. Chrome during TCP resends) catches up on a fresh one
+                queue.get_nowait()
+    except Exception as e:
+        logging.error(f"Error in generate_frames: {e}", exc_info=True)
+    finally:
+        viewers.discard(queue)
+
+
+@app.get('/')
+async def index():
+    """Redirects to the static HTML page with the video feed."""
+    return RedirectResponse('/static/index.html')
+
+
+@app.get('/video_feed')
+async def video_feed():
     """Route that serves the MJPEG video stream."""
-    if not picam2:# or not output_stream or not picam2.started: # Added check for picam2.started
+    if not picam2 or not output_stream:
         logging.error("Video feed requested, but camera is not ready or not started.")
-        return "Camera not ready", 503
+        return PlainTextResponse("Camera not ready", status_code=503)
 
-    return Response(generate_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+    return StreamingResponse(generate_frames(),
+                             media_type='multipart/x-mixed-replace; boundary=frame')
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-    if not initialize_camera_and_start_streaming():
-        logging.error("Application cannot start due to camera initialization failure.")
-    else:
-        try:
-            logging.info(f"Starting Flask server on http://0.0.0.0:{SERVER_PORT}")
-            app.run(host='0.0.0.0', port=SERVER_PORT, threaded=True, debug=False)
-        except KeyboardInterrupt:
-            logging.info("Keyboard interrupt received. Shutting down...")
-        except Exception as e:
-            logging.error(f"An error occurred while running the Flask app: {e}", exc_info=True)
-        finally:
-            if picam2:
-                logging.info("Shutting down camera...")
-                try:
-                    if picam2.started: # Check if recording was started before trying to stop
-                        picam2.stop_recording()
-                        logging.info("Camera recording stopped.")
-                except Exception as e:
-                    logging.error(f"Error stopping recording: {e}", exc_info=True)
-                try:
-                    picam2.close()
-                    logging.info("Camera closed.")
-                except Exception as e:
-                    logging.error(f"Error closing camera: {e}", exc_info=True)
-            logging.info("Application terminated.")
\ No newline at end of file
+    try:
+        logging.info(f"Starting Uvicorn server on http://0.0.0.0:{SERVER_PORT}")
+        # A single worker: the camera can only be opened by one process. /video_feed streams
+        # never end on their own, so cap the graceful shutdown or it waits on them forever
+        uvicorn.run(app, host='0.0.0.0', port=SERVER_PORT, workers=1, loop='uvloop',
+                    timeout_graceful_shutdown=SHUTDOWN_TIMEOUT)
+    except KeyboardInterrupt:
+        logging.info("Keyboard interrupt received. Shutting down...")
+    except Exception as e:
+        logging.error(f"An error occurred while running the server: {e}", exc_info=True)
+    finally:
+        # The lifespan normally closes the camera, but a forced exit skips lifespan shutdown
+        shutdown_camera()
+        logging.info("Application terminated.")
\ No newline at end of file
@@ -1,8 +1,9 @@
 import io
 import logging
-import socketserver
+import os
+import queue
 from http import server
-from threading import Condition
+from threading import BoundedSemaphore, Event, Thread
 
 from picamera2 import Picamera2
 from picamera2.encoders import JpegEncoder
@@ -24,16 +25,27 @@ PAGE = """\
 # Class to handle streaming output
 class StreamingOutput(io.BufferedIOBase):
     def __init__(self):
-        self.frame = None
-        self.condition = Condition()
+        self.slots = [None, None, None]  # Three slots, so the encoder never blocks on a client
+        self.seq = 0  # Number of frames published so far
+        self.event = Event()
 
     def write(self, buf):
-        with self.condition:
-            self.frame = buf
-            self.condition.notify_all()
+        seq = self.seq
+        # Copy memoryview/mmap input so the encoder can reuse its buffer; bytes pass through as is
+        self.slots[seq % 3] = bytes(buf)
+        self.seq = seq + 1
+        # Swap in a fresh event first so woken clients wait for the next frame
+        event, self.event = self.event, Event()
+        event.set()
+
+    def latest(self):
+        seq = self.seq
+        return seq, self.slots[(seq - 1) % 3] if seq else None
 
 # Class to handle HTTP requests
 class StreamingHandler(server.BaseHTTPRequestHandler):
+    timeout = 10  # Drop idle (e.g. browser preconnect) or stalled sockets so they can't hold a pool thread
+
     def do_GET(self):
         if self.path == '/':
             # Redirect root path to index.html
@@ -49,50 +61,95 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(content)
         elif self.path == '/stream.mjpg':
-            # Set up MJPEG streaming
-            self.send_response(200)
-            self.send_header('Age', 0)
-            self.send_header('Cache-Control', 'no-cache, private')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
-            self.end_headers()
+            if not self.server.streams.acquire(blocking=False):
+                # Every stream slot is taken; refuse instead of queueing the client behind them
+                self.send_error(503, 'Too many viewers')
+                return
             try:
-                while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-            except Exception as e:
-                logging.warning(
-                    'Removed streaming client %s: %s',
-                    self.client_address, str(e))
+                self.stream()
+            finally:
+                self.server.streams.release()
         else:
             # Handle 404 Not Found
             self.send_error(404)
             self.end_headers()
 
-# Class to handle streaming server
-class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
+    def stream(self):
+        """Serve the MJPEG stream until the client disconnects."""
+        # Set up MJPEG streaming
+        self.send_response(200)
+        self.send_header('Age', 0)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+        self.end_headers()
+        try:
+            # Looked up once per client instead of on every frame
+            out, write = output, self.wfile.write
+            send_header, end_headers = self.send_header, self.end_headers
+            last_seen = 0
+            while True:
+                event = out.event
+                if out.seq == last_seen and not event.wait(timeout=1.0):
+                    # No new frame yet; never resend a stale one or fall back to a capture
+                    continue
+                # latest() may be several frames past last_seen; those in between are skipped
+                last_seen, frame = out.latest()
+                write(b'--FRAME\r\n')
+                send_header('Content-Type', 'image/jpeg')
+                send_header('Content-Length', len(frame))
+                end_headers()
+                write(frame)
+                write(b'\r\n')
+        except Exception as e:
+            logging.warning(
+                'Removed streaming client %s: %s',
+                self.client_address, str(e))
+
+# Class to handle streaming server with a fixed pool of worker threads. Each MJPEG client holds
+# a thread for as long as it watches, so streams are capped at max_streams (later ones get a 503)
+# and page_threads more serve everything else. Those can still be tied up by slow or idle
+# connections, but only for the handler timeout, after which the socket is dropped
+class StreamingServer(server.HTTPServer):
     allow_reuse_address = True
-    daemon_threads = True
+
+    def __init__(self, address, handler, max_streams, page_threads):
+        super().__init__(address, handler)
+        self.streams = BoundedSemaphore(max_streams)
+        self.requests = queue.Queue()
+        for _ in range(max_streams + page_threads):
+            Thread(target=self.process_requests, daemon=True).start()
+
+    def process_request(self, request, client_address):
+        # Queue the connection for the pool instead of starting a thread per client
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
 
 # Create Picamera2 instance and configure it
 picam2 = Picamera2()
 picam2.configure(picam2.create_video_configuration(
     main={"size": (1920, 1080)},
+    lores={"size": (854, 480), "format": "YUV420"},  # Sized for the page, scaled by the ISP
+    encode="lores",
     controls={"FrameRate": 5}))
 output = StreamingOutput()
-picam2.start_recording(JpegEncoder(), FileOutput(output))
+# Encode on every core but one, which is left for the HTTP server
+encoder = JpegEncoder(num_threads=max(1, (os.cpu_count() or 1) - 1))
+picam2.start_recording(encoder, FileOutput(output), name="lores")
 
 try:
     # Set up and start the streaming server
     address = ('', 8000)
-    server = StreamingServer(address, StreamingHandler)
+    server = StreamingServer(address, StreamingHandler, max_streams=8, page_threads=2)
     server.serve_forever()
 finally:
     # Stop recording when the script is interrupted